@@ -38,8 +38,10 @@ class Project:
     def task_end_date(self, task):
         return add_days(self.project_start_date, task.start_point + task.man_day, task.man, self.vacations, False)
 
-    def is_delayed(self, task):
-        return task.status < 100 and self.task_end_date(task) < datetime.datetime.now().date()
+    def is_delayed(self, task, end_date = None):
+        if end_date == None:
+            end_date = self.task_end_date(task)
+        return task.status < 100 and end_date < datetime.datetime.now().date()
 
     def init_status(self):
         # calculate all the mans
@@ -90,6 +92,7 @@ class Task:
         self.start_point = None
         self.start_date = None
         self.end_date = None
+        self.lineno = None
 
 def is_weekend(date1):
     weekday = date1.isoweekday()
@@ -189,7 +192,7 @@ def parse_header_line(curr_headers, m):
 
     curr_headers.append([new_header_level, new_header])
 
-def parse_task_line(tasks, curr_headers, m):
+def parse_task_line(tasks, curr_headers, m, lineno = None):
     task_name = m.group(1).strip()
     if len(curr_headers) > 0:
         task_name = get_headers_as_str(curr_headers) + " :: " + task_name
@@ -207,6 +210,7 @@ def parse_task_line(tasks, curr_headers, m):
         status = m.group(6).strip()
 
     task = Task(task_name, man_day, man, status)
+    task.lineno = lineno
     tasks.append(task)
 
 def parse_vacation_line(vacations, m):
@@ -231,24 +235,30 @@ def parse(content):
 
     project_start_date = None
     curr_headers = []
-    for line in lines:
+    for lineno, line in enumerate(lines, 1):
 
         # parse task line
         m = re.search(TASK_LINE_PATTERN, line)
         if m:
-            parse_task_line(tasks, curr_headers, m)
+            parse_task_line(tasks, curr_headers, m, lineno)
             continue
 
         # parse vacation line
         m = re.search(VACATION_PATTERN, line)
         if m:
-            parse_vacation_line(vacations, m)
+            try:
+                parse_vacation_line(vacations, m)
+            except ValueError, e:
+                raise ParserException("Invalid date at line %d: %s" % (lineno, e.message))
             continue
 
         # parse project_start_date line
         m = re.search(PROJECT_START_DATE_PATTERN, line)
         if m and m.group(1):
-            project_start_date = parse_date(m.group(1).strip())
+            try:
+                project_start_date = parse_date(m.group(1).strip())
+            except ValueError, e:
+                raise ParserException("Invalid date at line %d: %s" % (lineno, e.message))
             continue
 
         # parse header line
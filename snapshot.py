@@ -0,0 +1,206 @@
+#-*-encoding: utf-8 -*-
+import os, time, sqlite3, threading
+import parser
+
+# at most one snapshot per plan in each interval of this many seconds
+SNAPSHOT_INTERVAL = 3600
+DOWNSAMPLE_STEPS = {"hour": 3600, "day": 86400, "week": 7 * 86400}
+# 1970-01-05, the first Monday after the epoch
+BUCKET_ORIGIN = 4 * 86400
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    plan TEXT NOT NULL,
+    man TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    finished_man_days REAL NOT NULL,
+    total_man_days REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS snapshots_plan_man_ts ON snapshots (plan, man, ts);
+"""
+
+def to_unicode(s):
+    if isinstance(s, str):
+        return s.decode("utf-8")
+    return s
+
+def date_to_timestamp(d):
+    return int(time.mktime(d.timetuple()))
+
+def bucket_of(ts, step):
+    """
+    按本地时区对齐到step的整数倍, 这样按天聚合的时候一天就是一个自然日。
+    起点是周一(BUCKET_ORIGIN), 这样按周聚合的时候是周一到周日。
+    """
+    offset = time.altzone if time.localtime(ts).tm_isdst > 0 else time.timezone
+    offset += BUCKET_ORIGIN
+    return (ts - offset) // step * step + offset
+
+class SnapshotPoint:
+    def __init__(self, ts, finished_man_days, total_man_days):
+        self.ts = ts
+        self.finished_man_days = finished_man_days
+        self.total_man_days = total_man_days
+        self.velocity = 0
+
+    def to_json(self):
+        return {
+            "time": self.ts,
+            "date": time.strftime("%Y-%m-%d", time.localtime(self.ts)),
+            "finished": self.finished_man_days,
+            "total": self.total_man_days,
+            "remaining": self.total_man_days - self.finished_man_days,
+            "velocity": self.velocity
+        }
+
+class SnapshotStore:
+    """
+    Append-only storage of plan progress, one row per (plan, man, time).
+    The whole plan is stored under the man parser.THE_ALL_MAN.
+
+    A row is only written when the progress of the man changed, so the
+    value of a man at any time is the one of his latest row before it.
+    """
+    def __init__(self, dbpath, interval=SNAPSHOT_INTERVAL):
+        # yash.py --snapshot changes the working directory after opening the store
+        self.dbpath = os.path.abspath(dbpath)
+        self.interval = interval
+        self.lock = threading.Lock()
+        # plan -> ts of the last written snapshot
+        self.last_ts = {}
+        # plan -> {man: (finished_man_days, total_man_days)} as last stored
+        self.last_stats = {}
+
+        dirname = os.path.dirname(self.dbpath)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        conn = self.connect()
+        conn.executescript(SCHEMA)
+        conn.close()
+
+    def connect(self):
+        return sqlite3.connect(self.dbpath)
+
+    def load_last(self, conn, plan):
+        last_ts = None
+        last_stats = {}
+        # sqlite returns the other columns of the row with the MAX(ts)
+        sql = "SELECT man, finished_man_days, total_man_days, MAX(ts) FROM snapshots WHERE plan = ? GROUP BY man"
+        for man, finished_man_days, total_man_days, ts in conn.execute(sql, (plan,)):
+            last_stats[man] = (finished_man_days, total_man_days)
+            last_ts = max(last_ts, ts)
+
+        self.last_ts[plan] = last_ts
+        self.last_stats[plan] = last_stats
+
+    def record(self, plan, man_stats, now=None):
+        """
+        Record the progress of `plan`, `man_stats` is the result of
+        yash.pretty_print_man_stats. Returns False if nothing was written,
+        because the plan was already snapshotted in the current interval
+        or its progress did not change.
+        """
+        plan = to_unicode(plan)
+        if now is None:
+            now = int(time.time())
+
+        with self.lock:
+            conn = self.connect()
+            try:
+                if not plan in self.last_stats:
+                    self.load_last(conn, plan)
+
+                # compare intervals rather than elapsed seconds, so an hourly
+                # cron job which starts a bit early still gets recorded
+                last_ts = self.last_ts[plan]
+                if last_ts is not None and last_ts // self.interval == now // self.interval:
+                    return False
+
+                stats = {}
+                finished_man_days = 0
+                total_man_days = 0
+                for man, man_stat in man_stats.iteritems():
+                    finished_man_days += man_stat[0]
+                    total_man_days += man_stat[1]
+                    stats[to_unicode(man)] = (man_stat[0], man_stat[1])
+                stats[parser.THE_ALL_MAN] = (finished_man_days, total_man_days)
+
+                last_stats = self.last_stats[plan]
+                # a man who left the plan has nothing to do any more
+                for man in last_stats:
+                    if not man in stats and last_stats[man] != (0, 0):
+                        stats[man] = (0, 0)
+
+                rows = [(plan, man, now, stat[0], stat[1])
+                        for man, stat in stats.iteritems() if last_stats.get(man) != stat]
+                if len(rows) == 0:
+                    return False
+
+                with conn:
+                    conn.executemany("INSERT INTO snapshots VALUES (?, ?, ?, ?, ?)", rows)
+                self.last_ts[plan] = now
+                last_stats.update(stats)
+                return True
+            finally:
+                conn.close()
+
+    def query(self, plan, man=None, start=None, end=None, step=None):
+        """
+        Query the snapshots of `plan` (of `man` if specified) in [start, end).
+        With `step`, returns one point per `step` seconds up to `end` (or
+        now), holding the latest value at the end of the step.
+        """
+        plan = to_unicode(plan)
+        if not man:
+            man = parser.THE_ALL_MAN
+        man = to_unicode(man)
+
+        sql = "SELECT ts, finished_man_days, total_man_days FROM snapshots WHERE plan = ? AND man = ?"
+        args = [plan, man]
+        if end is not None:
+            sql += " AND ts < ?"
+            args.append(end)
+        if start is not None:
+            # the latest row before start is the value at start
+            sql += " AND ts >= IFNULL((SELECT MAX(ts) FROM snapshots WHERE plan = ? AND man = ? AND ts < ?), ?)"
+            args.extend([plan, man, start, start])
+        sql += " ORDER BY ts"
+
+        conn = self.connect()
+        try:
+            rows = conn.execute(sql, args).fetchall()
+        finally:
+            conn.close()
+
+        if not step:
+            points = [SnapshotPoint(ts, finished_man_days, total_man_days)
+                      for ts, finished_man_days, total_man_days in rows
+                      if start is None or ts >= start]
+        else:
+            points = []
+            if len(rows) > 0:
+                last = int(time.time())
+                if end is not None:
+                    last = min(last, end - 1)
+
+                bucket = bucket_of(max(rows[0][0], start), step)
+                last_bucket = bucket_of(last, step)
+                idx = 0
+                value = None
+                while bucket <= last_bucket:
+                    # the next bucket, stepping into its middle to be safe from DST shifts
+                    next_bucket = bucket_of(bucket + step + step // 2, step)
+                    while idx < len(rows) and rows[idx][0] < next_bucket:
+                        value = rows[idx]
+                        idx += 1
+
+                    points.append(SnapshotPoint(bucket, value[1], value[2]))
+                    bucket = next_bucket
+
+        # velocity: finished man days per day between two points
+        for prev, curr in zip(points, points[1:]):
+            days = float(curr.ts - prev.ts) / 86400
+            curr.velocity = (curr.finished_man_days - prev.finished_man_days) / days
+
+        return points
@@ -0,0 +1,279 @@
+#-*-encoding: utf-8 -*-
+import os, re, codecs
+import multiprocessing
+from math import floor
+import parser
+
+# lines which start like a task (`* xxx -- ...`) but are not a valid task or vacation
+TASK_LIKE_PATTERN = "^\s*\*.*\-\-"
+# lines which start like `* ProjectStartDate:` but have no valid date
+START_DATE_LIKE_PATTERN = "^\s*(\*\s*)?ProjectStartDate\s*\:"
+PLAN_FILE_SUFFIXES = (".plan.md", ".plan.markdown")
+# below this many files, forking workers costs more than it saves
+MIN_PARALLEL_FILES = 64
+PARALLEL_CHUNK_SIZE = 16
+UNASSIGNED_MAN = "TODO"
+# tolerance when adding up fractional man days
+CAPACITY_EPSILON = 1e-6
+# other tasks named in an over capacity warning
+MAX_LISTED_BOOKINGS = 3
+
+ERROR = "error"
+WARNING = "warning"
+
+class Issue:
+    def __init__(self, path, lineno, level, message):
+        self.path = path
+        self.lineno = lineno
+        self.level = level
+        self.message = message
+
+    def to_json(self):
+        return {
+            "file": self.path,
+            "line": self.lineno,
+            "level": self.level,
+            "message": self.message
+        }
+
+    def __str__(self):
+        location = self.path
+        if self.lineno != None:
+            location += ":" + str(self.lineno)
+
+        return (u"%s: %s: %s" % (location, self.level, self.message)).encode("utf-8")
+
+class Booking:
+    """
+    An owner works on the task at `path`:`lineno` from `start_point` for
+    `man_day` days, counted in working days from `project_start_date`.
+    """
+    def __init__(self, man, start_point, man_day, project_start_date, path, lineno):
+        self.man = man
+        self.start_point = start_point
+        self.man_day = man_day
+        self.project_start_date = project_start_date
+        self.path = path
+        self.lineno = lineno
+
+def lint(path, content):
+    """
+    Check the content of plan `path`, returns (issues, bookings).
+    """
+    issues = []
+    vacations = {}
+    has_start_date = False
+
+    for lineno, line in enumerate(content.split('\n'), 1):
+        if re.search(parser.TASK_LINE_PATTERN, line):
+            continue
+
+        m = re.search(parser.VACATION_PATTERN, line)
+        if m:
+            line_vacations = {}
+            try:
+                parser.parse_vacation_line(line_vacations, m)
+            except ValueError, e:
+                issues.append(Issue(path, lineno, ERROR, u"Invalid vacation date: " + e.message))
+                continue
+
+            man = m.group(1).strip()
+            dates = line_vacations[man]
+            if len(dates) == 0:
+                issues.append(Issue(path, lineno, WARNING, u"Vacation of %s ends before it starts" % man))
+                continue
+
+            if not man in vacations:
+                vacations[man] = []
+            vacations[man].append((dates[0], dates[-1], lineno))
+            continue
+
+        m = re.search(parser.PROJECT_START_DATE_PATTERN, line)
+        if m:
+            try:
+                parser.parse_date(m.group(1).strip())
+                has_start_date = True
+            except ValueError, e:
+                issues.append(Issue(path, lineno, ERROR, u"Invalid ProjectStartDate: " + e.message))
+            continue
+
+        if re.search(START_DATE_LIKE_PATTERN, line):
+            issues.append(Issue(path, lineno, ERROR, u"Unparsed ProjectStartDate line"))
+            continue
+
+        if re.search(TASK_LIKE_PATTERN, line):
+            issues.append(Issue(path, lineno, WARNING, u"Line looks like a task but can not be parsed"))
+
+    if not has_start_date:
+        issues.append(Issue(path, None, ERROR, u"Please specify the project start date!"))
+
+    for man, ranges in vacations.iteritems():
+        ranges = sorted(ranges)
+        # the range which ends the latest so far
+        latest = ranges[0]
+        for curr in ranges[1:]:
+            if curr[0] <= latest[1]:
+                issues.append(Issue(path, curr[2], WARNING,
+                                    u"Vacation of %s overlaps with line %d" % (man, latest[2])))
+            if curr[1] > latest[1]:
+                latest = curr
+
+    bookings = []
+    if len([x for x in issues if x.level == ERROR]) > 0:
+        return issues, bookings
+
+    try:
+        project = parser.parse(content)
+    except parser.ParserException, e:
+        issues.append(Issue(path, None, ERROR, e.message))
+        return issues, bookings
+
+    for task in project.tasks:
+        if task.man != UNASSIGNED_MAN:
+            bookings.append(Booking(task.man, task.start_point, task.man_day,
+                                    project.project_start_date, path, task.lineno))
+
+    return issues, bookings
+
+def lint_file(args):
+    root, path = args
+    try:
+        input_file = codecs.open(os.path.join(root, path), mode="r", encoding="utf-8")
+        content = input_file.read()
+        input_file.close()
+    except (IOError, UnicodeDecodeError), e:
+        return [Issue(path, None, ERROR, unicode(e))], []
+
+    return lint(path, content)
+
+def check_capacity(bookings):
+    """
+    Plans in the same composite directory are scheduled in parallel, so
+    an owner who has more than one man day of work on a day is over capacity.
+    """
+    if len(bookings) == 0:
+        return []
+
+    # put the plans on one timeline, the same way as yash.ProjectWrapper
+    _, min_project_start_date = parser.skip_weekend(min([x.project_start_date for x in bookings]))
+    margins = {}
+    man_day2load = {} # (man, day) -> [man_days, bookings]
+    for booking in bookings:
+        if not booking.project_start_date in margins:
+            margins[booking.project_start_date] = parser.calculate_date_delta_skip_weekend(
+                min_project_start_date,
+                booking.project_start_date
+            )
+
+        start = booking.start_point + margins[booking.project_start_date]
+        end = start + booking.man_day
+        day = int(floor(start))
+        while day < end:
+            key = (booking.man, day)
+            if not key in man_day2load:
+                man_day2load[key] = [0, []]
+
+            man_day2load[key][0] += min(day + 1, end) - max(day, start)
+            man_day2load[key][1].append(booking)
+            day += 1
+
+    issues = []
+    reported = set()
+    for (man, day), (man_days, day_bookings) in sorted(man_day2load.iteritems()):
+        if man_days <= 1 + CAPACITY_EPSILON:
+            continue
+
+        date = parser.add_days(min_project_start_date, day)
+        for booking in day_bookings:
+            # report every task only once, on its first overloaded day
+            if booking in reported:
+                continue
+            reported.add(booking)
+
+            others = []
+            more = 0
+            for x in day_bookings:
+                if x.path == booking.path:
+                    continue
+                if len(others) < MAX_LISTED_BOOKINGS:
+                    others.append(u"%s:%s" % (x.path, x.lineno))
+                else:
+                    more += 1
+            if more > 0:
+                others.append(u"%d more" % more)
+
+            issues.append(Issue(booking.path, booking.lineno, WARNING,
+                                u"%s is over capacity on %s (%g man days): also busy with %s" % (
+                                    man, date, man_days, ", ".join(others))))
+
+    return issues
+
+def find_plans(root):
+    """
+    Returns (plan files, directories containing a .plan file), relative to `root`.
+    """
+    plans = []
+    composite_dirs = []
+    # real paths of the walked directories, so symlink cycles are walked only once
+    visited = set([os.path.realpath(root)])
+    for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+        subdirs = []
+        for dirname in dirnames:
+            realpath = os.path.realpath(os.path.join(dirpath, dirname))
+            if not dirname.startswith(".") and not realpath in visited:
+                visited.add(realpath)
+                subdirs.append(dirname)
+        dirnames[:] = subdirs
+
+        reldir = os.path.relpath(dirpath, root)
+        if reldir == ".":
+            reldir = ""
+
+        if ".plan" in filenames:
+            composite_dirs.append(reldir)
+
+        for filename in filenames:
+            if filename.endswith(PLAN_FILE_SUFFIXES) and not filename.startswith("."):
+                plans.append(os.path.join(reldir, filename))
+
+    return plans, composite_dirs
+
+def check_file(path):
+    """
+    Check the single plan `path`, returns the issues sorted by line.
+    """
+    issues, _ = lint_file(("", path))
+    return sorted(issues, key = lambda x : x.lineno)
+
+def check_tree(root, parallel = True):
+    """
+    Check all the plans under `root`, in parallel unless `parallel` is
+    False, returns the issues sorted by file and line.
+    """
+    plans, composite_dirs = find_plans(root)
+    jobs = [(root, plan) for plan in plans]
+
+    if not parallel or len(jobs) < MIN_PARALLEL_FILES:
+        results = map(lint_file, jobs)
+    else:
+        pool = multiprocessing.Pool()
+        try:
+            results = list(pool.imap_unordered(lint_file, jobs, PARALLEL_CHUNK_SIZE))
+        finally:
+            pool.close()
+            pool.join()
+
+    issues = []
+    dir2bookings = dict([(d, []) for d in composite_dirs])
+    for file_issues, bookings in results:
+        issues.extend(file_issues)
+        for booking in bookings:
+            # the composite plan only includes the .plan.md files
+            dirname = os.path.dirname(booking.path)
+            if dirname in dir2bookings and booking.path.endswith(".plan.md"):
+                dir2bookings[dirname].append(booking)
+
+    for bookings in dir2bookings.itervalues():
+        issues.extend(check_capacity(bookings))
+
+    return sorted(issues, key = lambda x : (x.path, x.lineno))
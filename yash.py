@@ -10,8 +10,17 @@ from search import Search, SearchResult
 import simpleyaml
 import StringIO
 import parser
+import snapshot
+import validate
 import getopt
 import json
+import csv
+import hashlib
+import datetime
+import time
+import threading
+import sqlite3
+import urllib
 
 reload(sys)
 sys.setdefaultencoding('utf8')
@@ -22,6 +31,12 @@ TEMPLATE_PATH = [os.path.join(os.getcwd(), "views")]
 SUPPORTED_PLAIN_FILE_TYPES = ["markdown", "md", "txt", "plan", "py", "org"]
 COMPOSITE_PLAN_NAME = "__summary__.plan.md"
 COMPOSITE_PLAN_TITLE = u"_总计划_"
+SNAPSHOT_DB = os.path.expanduser("~/.yash/snapshots.db")
+SNAPSHOTS = None
+# plan -> modification times of its files when it was last snapshotted
+PLAN_MTIMES = {}
+EXPORT_CHUNK_ROWS = 256
+EXPORT_CSV_HEADER = ["task", "owner", "man_days", "progress", "start", "end", "delayed"]
 
 class ProjectWrapper(parser.Project):
     def __init__(self, delegate_projects):
@@ -55,6 +70,11 @@ class ProjectWrapper(parser.Project):
         # sort the tasks
         self.tasks = sorted(self.tasks, key = lambda task : task.start_point)
 
+        # the start_point and vacations changed, refresh the dates calculated by the delegates
+        for task in self.tasks:
+            task.start_date = self.task_start_date(task)
+            task.end_date = self.task_end_date(task)
+
         # mans
         mans = set([])
         for project in delegate_projects:
@@ -155,34 +175,34 @@ def extract_file_title_by_fullurl(fullurl):
 def format_date(d):
     return d.strftime("%m-%d")
 
-@get('/<filename:re:.*\.plan\.(md|markdown)>')
-@view('gantt')
-def serve_plan(filename):
+def load_plan(filename):
+    """
+    Parse the plan `filename`, which may be a composite plan.
+    Returns (project, text, error), text is None for composite plans.
+    """
     fullpath   = os.getcwd() + "/" + filename
-    man = request.GET.get('man')
 
     error = None
-    if not os.path.exists(fullpath):
-        basename = os.path.basename(fullpath)
-        dirname = os.path.dirname(fullpath)
-        if basename == COMPOSITE_PLAN_NAME and os.path.exists(dirname + "/" + ".plan"):
-            plan_files = os.listdir(dirname)
-            plan_files = [x for x in plan_files if x.endswith(".plan.md")]
-            projects = []
-            for plan in plan_files:
-                fullpath = dirname + "/" + plan
-                text = read_file_from_disk(fullpath)
-                try:
-                    project = parser.parse(text)
-                except parser.ParserException, e:
-                    print e
-                    error = e.message + "(file: " + fullpath + ")"
-
-                projects.append(project)
-
+    text = None
+    basename = os.path.basename(fullpath)
+    dirname = os.path.dirname(fullpath)
+    if not os.path.exists(fullpath) and basename == COMPOSITE_PLAN_NAME and os.path.exists(dirname + "/" + ".plan"):
+        plan_files = os.listdir(dirname)
+        plan_files = [x for x in plan_files if x.endswith(".plan.md")]
+        projects = []
+        for plan in plan_files:
+            fullpath = dirname + "/" + plan
+            plan_text = read_file_from_disk(fullpath)
+            try:
+                projects.append(parser.parse(plan_text))
+            except parser.ParserException, e:
+                print e
+                error = e.message + "(file: " + fullpath + ")"
+
+        if len(projects) > 0:
             project = ProjectWrapper(projects)
-            raw_text = ""
-            show_text = False
+        else:
+            project = parser.EmptyProject
     else:
         text = read_file_from_disk(fullpath)
         try:
@@ -191,14 +211,23 @@ def serve_plan(filename):
             print e
             error = e.message + "(file: " + fullpath + ")"
 
-        raw_text = read_file_from_disk(fullpath)
-        raw_text = render_markdown(raw_text)
+    if error != None:
+        project = parser.EmptyProject
 
-        show_text = True
+    return project, text, error
 
+@get('/<filename:re:.*\.plan\.(md|markdown)>')
+@view('gantt')
+def serve_plan(filename):
+    man = request.GET.get('man')
+
+    project, text, error = load_plan(filename)
     if error != None:
-        project = parser.EmptyProject
         raw_text = error
+    elif text == None:
+        raw_text = ""
+    else:
+        raw_text = render_markdown(text)
 
     # make project info to json
     texts = []
@@ -209,9 +238,9 @@ def serve_plan(filename):
         taskjson["cleanedTaskName"] = task.name.encode("utf-8")
         taskjson["owner"] = task.man.encode("utf-8")
         taskjson["cost"] = task.man_day
-        taskjson["start"] = format_date(project.task_start_date(task))
-        taskjson["end"] = format_date(project.task_end_date(task))
-        taskjson["isDelayed"] = str(project.is_delayed(task))
+        taskjson["start"] = format_date(task.start_date)
+        taskjson["end"] = format_date(task.end_date)
+        taskjson["isDelayed"] = str(project.is_delayed(task, task.end_date))
         taskjson["progress"] = str(task.status)
         texts.append(taskjson)
 
@@ -221,9 +250,6 @@ def serve_plan(filename):
     man_stats = pretty_print_man_stats(project.tasks)
     breadcrumbs = calculate_breadcrumbs(fullurl)
 
-    # render the raw text
-    fullpath   = os.getcwd() + "/" + filename
-
     return dict(html = html,
                 title = title,
                 project = project,
@@ -250,6 +276,233 @@ def pretty_print_man_stats(tasks):
     return man2days
 
 
+def export_tasks(project):
+    """
+    Yields (task, start_date, end_date, is_delayed) of every task in `project`.
+    """
+    for task in project.tasks:
+        yield task, task.start_date, task.end_date, project.is_delayed(task, task.end_date)
+
+def export_csv(project):
+    buf = StringIO.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_CSV_HEADER)
+    for idx, (task, start_date, end_date, is_delayed) in enumerate(export_tasks(project)):
+        writer.writerow([
+            task.name.encode("utf-8"),
+            task.man.encode("utf-8"),
+            task.man_day,
+            task.status,
+            start_date.isoformat(),
+            end_date.isoformat(),
+            is_delayed
+        ])
+
+        # flush every EXPORT_CHUNK_ROWS rows, so we never hold the whole document
+        if (idx + 1) % EXPORT_CHUNK_ROWS == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+
+    yield buf.getvalue()
+
+def ical_escape(text):
+    return text.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+def ical_line(line):
+    """
+    Encode `line` to utf-8, folded to lines of at most 75 octets (RFC 5545).
+    """
+    lines = []
+    curr = ""
+    for c in line:
+        b = c.encode("utf-8")
+        if len(curr) + len(b) > 75:
+            lines.append(curr)
+            curr = " "
+        curr += b
+    lines.append(curr)
+    return "\r\n".join(lines) + "\r\n"
+
+def ical_uid(filename, task, occurrence):
+    """
+    UID of the event of `task`, stable when other tasks are added or reordered.
+    `occurrence` tells apart the tasks with the same name.
+    """
+    key = u"%s\n%s\n%d" % (filename.decode("utf-8"), task.name, occurrence)
+    return u"%s@yash" % hashlib.md5(key.encode("utf-8")).hexdigest()
+
+def export_ical(project, filename):
+    name2occurrences = {}
+    dtstamp = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+    title = extract_file_title_by_fullurl("/" + filename)
+
+    buf = [
+        ical_line(u"BEGIN:VCALENDAR"),
+        ical_line(u"VERSION:2.0"),
+        ical_line(u"PRODID:-//yash//plan export//EN"),
+        ical_line(u"X-WR-CALNAME:" + ical_escape(title))
+    ]
+    for idx, (task, start_date, end_date, is_delayed) in enumerate(export_tasks(project)):
+        description = u"负责人: %s, 人日: %s, 进度: %d%%" % (task.man, task.man_day, task.status)
+        occurrence = name2occurrences.get(task.name, 0)
+        name2occurrences[task.name] = occurrence + 1
+
+        buf.append(ical_line(u"BEGIN:VEVENT"))
+        buf.append(ical_line(u"UID:" + ical_uid(filename, task, occurrence)))
+        buf.append(ical_line(u"DTSTAMP:" + dtstamp))
+        buf.append(ical_line(u"DTSTART;VALUE=DATE:" + start_date.strftime("%Y%m%d")))
+        # DTEND of an all-day event is exclusive
+        buf.append(ical_line(u"DTEND;VALUE=DATE:" + (end_date + datetime.timedelta(days=1)).strftime("%Y%m%d")))
+        buf.append(ical_line(u"SUMMARY:" + ical_escape(u"%s [%s]" % (task.name, task.man))))
+        buf.append(ical_line(u"DESCRIPTION:" + ical_escape(description)))
+        buf.append(ical_line(u"END:VEVENT"))
+
+        if (idx + 1) % EXPORT_CHUNK_ROWS == 0:
+            yield "".join(buf)
+            buf = []
+
+    buf.append(ical_line(u"END:VCALENDAR"))
+    yield "".join(buf)
+
+def content_disposition(filename):
+    """
+    Content-Disposition of a download named `filename`, with an ASCII
+    fallback for old clients and the real name in RFC 5987 encoding.
+    """
+    if isinstance(filename, unicode):
+        filename = filename.encode("utf-8")
+
+    fallback = re.sub("[^A-Za-z0-9._-]", "_", filename)
+    return "attachment; filename=\"%s\"; filename*=UTF-8''%s" % (fallback, urllib.quote(filename, safe = ""))
+
+@get('/<filename:re:.*\.plan\.(md|markdown)>.csv')
+def export_plan_csv(filename):
+    project, _, error = load_plan(filename)
+    if error != None:
+        abort(400, error)
+
+    response.content_type = "text/csv; charset=utf-8"
+    response.set_header("Content-Disposition", content_disposition(os.path.basename(filename) + ".csv"))
+    return export_csv(project)
+
+@get('/<filename:re:.*\.plan\.(md|markdown)>.ics')
+def export_plan_ical(filename):
+    project, _, error = load_plan(filename)
+    if error != None:
+        abort(400, error)
+
+    response.content_type = "text/calendar; charset=utf-8"
+    response.set_header("Content-Disposition", content_disposition(os.path.basename(filename) + ".ics"))
+    return export_ical(project, filename)
+
+def plan_mtimes(filename):
+    """
+    Modification times of the files the plan `filename` is made of.
+    """
+    fullpath = os.getcwd() + "/" + filename
+    if os.path.basename(filename) == COMPOSITE_PLAN_NAME and not os.path.exists(fullpath):
+        dirname = os.path.dirname(fullpath)
+        return sorted([(x, os.path.getmtime(dirname + "/" + x))
+                       for x in os.listdir(dirname) if x.endswith(".plan.md")])
+
+    return os.path.getmtime(fullpath)
+
+def record_snapshots(store):
+    """
+    Snapshot every plan (including the composite plans) under the
+    current directory.
+    """
+    root = os.getcwd()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [x for x in dirnames if not x.startswith(".")]
+        reldir = dirpath[len(root):].strip("/")
+
+        plans = [x for x in filenames if re.search("\.plan\.(md|markdown)$", x) and not x.startswith(".")]
+        if ".plan" in filenames and not COMPOSITE_PLAN_NAME in plans:
+            plans.append(COMPOSITE_PLAN_NAME)
+
+        for plan in plans:
+            filename = os.path.join(reldir, plan)
+            try:
+                # skip the plans whose files did not change since the last round
+                mtimes = plan_mtimes(filename)
+                if PLAN_MTIMES.get(filename) == mtimes:
+                    continue
+
+                project, _, error = load_plan(filename)
+            except (OSError, bottle.HTTPError):
+                # the plan is deleted while we are walking
+                continue
+
+            PLAN_MTIMES[filename] = mtimes
+            if error == None:
+                store.record(filename, pretty_print_man_stats(project.tasks))
+
+def record_snapshots_forever(store):
+    while True:
+        try:
+            record_snapshots(store)
+        except Exception, e:
+            print e
+
+        time.sleep(store.interval)
+
+@get('/_burndown')
+def serve_burndown():
+    plan = request.GET.get('plan', '').strip("/")
+    man = request.GET.get('man')
+    start = request.GET.get('start')
+    end = request.GET.get('end')
+    step = request.GET.get('step', 'day')
+
+    if len(plan) == 0:
+        abort(400, "Please specify the plan!")
+    if step not in snapshot.DOWNSAMPLE_STEPS:
+        abort(400, "step should be one of: " + ", ".join(sorted(snapshot.DOWNSAMPLE_STEPS)))
+
+    try:
+        if start:
+            start = snapshot.date_to_timestamp(parser.parse_date(start))
+        if end:
+            # end date is inclusive
+            end = snapshot.date_to_timestamp(parser.parse_date(end)) + 86400
+    except ValueError, e:
+        abort(400, "Invalid date: " + e.message)
+
+    points = []
+    if SNAPSHOTS != None:
+        points = SNAPSHOTS.query(plan, man, start, end, snapshot.DOWNSAMPLE_STEPS[step])
+
+    response.content_type = "application/json"
+    return json.dumps({
+        "plan": plan,
+        "man": man,
+        "step": step,
+        "points": [point.to_json() for point in points]
+    })
+
+@get('/_validate')
+def serve_validate():
+    path = request.GET.get('path', '').strip("/")
+    home = os.path.realpath(os.getcwd())
+    root = os.path.realpath(os.path.join(home, path))
+    if root != home and not root.startswith(home + os.sep):
+        abort(403, "You can only validate the plans under " + home)
+    if not os.path.isdir(root):
+        abort(404, "Nothing to see here, honey!")
+
+    # don't fork a process pool from the web server
+    issues = validate.check_tree(root, parallel = False)
+
+    response.content_type = "application/json"
+    return json.dumps({
+        "path": path,
+        "errors": len([x for x in issues if x.level == validate.ERROR]),
+        "warnings": len([x for x in issues if x.level == validate.WARNING]),
+        "issues": [issue.to_json() for issue in issues]
+    })
+
 @route('/<filename:re:.*\.xml>')
 def xml_files(filename):
     fullpath   = os.getcwd() + "/" + filename
@@ -370,15 +623,67 @@ def directories(filename):
                 )
 
 if __name__ == '__main__':
-    opts, args = getopt.getopt(sys.argv[1:], 'p:h')
+    opts, args = getopt.getopt(sys.argv[1:], 'p:s:h', ['check=', 'snapshot='])
 
     port = 80
+    snapshot_db = SNAPSHOT_DB
+    check_dir = None
+    snapshot_dir = None
     for opt_name, opt_value in opts:
         opt_value = opt_value.strip()
         if opt_name == '-p':
             port = int(opt_value)
+        if opt_name == '-s':
+            snapshot_db = opt_value
+        if opt_name == '--check':
+            check_dir = opt_value
+        if opt_name == '--snapshot':
+            snapshot_dir = opt_value
         if opt_name == '-h':
-            print """Usage: yash.py -p <port>"""
+            print """Usage: yash.py -p <port> [-s <snapshot db>]
+       yash.py --check <dir or plan file> [<dir or plan file> ...]
+       yash.py --snapshot <dir> [-s <snapshot db>]"""
+
+    if check_dir != None:
+        # a commit hook passes the changed files as the rest of the arguments
+        issues = []
+        for path in [check_dir] + args:
+            if os.path.isdir(path):
+                issues.extend(validate.check_tree(path))
+            elif os.path.isfile(path):
+                if path.endswith(validate.PLAN_FILE_SUFFIXES):
+                    issues.extend(validate.check_file(path))
+            else:
+                print "No such file or directory: " + path
+                sys.exit(2)
+
+        errors = 0
+        for issue in issues:
+            print issue
+            if issue.level == validate.ERROR:
+                errors += 1
+
+        print "%d errors, %d warnings" % (errors, len(issues) - errors)
+        sys.exit(errors > 0 and 1 or 0)
+
+    try:
+        SNAPSHOTS = snapshot.SnapshotStore(snapshot_db)
+    except (OSError, sqlite3.Error), e:
+        print "Can not open the snapshot database %s, burn-down data is disabled: %s" % (snapshot_db, e)
+        # nothing to record into
+        if snapshot_dir != None:
+            sys.exit(1)
+
+    # snapshot once and exit, e.g. from cron
+    if snapshot_dir != None:
+        os.chdir(snapshot_dir)
+        record_snapshots(SNAPSHOTS)
+        sys.exit(0)
+
+    if SNAPSHOTS != None:
+        recorder = threading.Thread(target = record_snapshots_forever, args = (SNAPSHOTS,))
+        recorder.daemon = True
+        recorder.start()
 
     YASH_HOME = sys.path[0]
     bottle.TEMPLATE_PATH = [os.path.join(YASH_HOME, "views")]